@@ -520,6 +520,8 @@ def _smoother(filter_posterior, movement_state_transition,
 def scale_likelihood(log_likelihood):
     '''Scales the likelihood to its max value to prevent overflow and underflow.
 
+    The scaling is done in place, so `log_likelihood` is overwritten.
+
     Parameters
     ----------
     log_likelihood : ndarray, shape (n_time, n_states, n_position_bins)
@@ -529,5 +531,5 @@ def scale_likelihood(log_likelihood):
     scaled_likelihood : ndarray, shape (n_time, n_states, n_position_bins)
 
     '''
-    return np.exp(log_likelihood -
-                  np.nanmax(log_likelihood, axis=(1, 2), keepdims=True))
+    log_likelihood -= np.nanmax(log_likelihood, axis=(1, 2), keepdims=True)
+    return np.exp(log_likelihood, out=log_likelihood)
@@ -367,23 +367,26 @@ def fit_multiunit_likelihood(position, multiunit, is_training,
     )
 
 
-@numba.njit(nogil=True, cache=True, parallel=True, error_model='numpy')
+@numba.njit(nogil=True, cache=True, parallel=True, error_model='numpy',
+            fastmath=True)
 def numba_kde(eval_points, samples, bandwidths):
     n_eval_points, n_bandwidths = eval_points.shape
     result = np.zeros((n_eval_points,))
     n_samples = len(samples)
 
+    inverse_bandwidths = 1.0 / bandwidths
+    log_normalization = 0.0
+    for k in range(n_bandwidths):
+        log_normalization -= np.log(bandwidths[k] * SQRT_2PI * bandwidths[k])
+
     for i in numba.prange(n_eval_points):
         for j in range(n_samples):
-            product_kernel = 1.0
+            squared_distance = 0.0
             for k in range(n_bandwidths):
-                bandwidth = bandwidths[k]
-                eval_point = eval_points[i, k]
-                sample = samples[j, k]
-                product_kernel *= (np.exp(
-                    -0.5 * ((eval_point - sample) / bandwidth)**2) /
-                    (bandwidth * SQRT_2PI)) / bandwidth
-            result[i] += product_kernel
+                distance = (eval_points[i, k] - samples[j, k]) * (
+                    inverse_bandwidths[k])
+                squared_distance += distance * distance
+            result[i] += np.exp(-0.5 * squared_distance + log_normalization)
         result[i] /= n_samples
 
     return result
@@ -394,9 +397,11 @@ class NumbaKDE(BaseEstimator, DensityMixin):
         self.bandwidth = bandwidth
 
     def fit(self, X, y=None, sample_weight=None):
-        self.training_data = X
+        self.training_data = np.ascontiguousarray(X, dtype=np.float64)
         return self
 
     def score_samples(self, X):
-        return np.log(numba_kde(X, self.training_data,
-                                self.bandwidth[-X.shape[1]:]))
+        bandwidths = np.ascontiguousarray(
+            self.bandwidth[-X.shape[1]:], dtype=np.float64)
+        return np.log(numba_kde(np.ascontiguousarray(X, dtype=np.float64),
+                                self.training_data, bandwidths))
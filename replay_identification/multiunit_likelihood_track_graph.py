@@ -1,70 +1,101 @@
-import dask
 import networkx as nx
 import numba
 import numpy as np
-from scipy.stats import multivariate_normal
+from scipy.sparse.csgraph import dijkstra
 
 SQRT_2PI = np.float64(np.sqrt(2.0 * np.pi))
 
 
+def _find_closest_ind(sorted_values, values):
+    '''Index of the first element of `sorted_values` closest to each value.
+
+    Parameters
+    ----------
+    sorted_values : np.ndarray, shape (n_sorted,)
+    values : np.ndarray, shape (n_values,)
+
+    Returns
+    -------
+    closest_ind : np.ndarray, shape (n_values,)
+
+    '''
+    right_ind = np.clip(
+        np.searchsorted(sorted_values, values), 1, len(sorted_values) - 1)
+    left_ind = np.searchsorted(sorted_values, sorted_values[right_ind - 1])
+    right_ind = np.searchsorted(sorted_values, sorted_values[right_ind])
+    return np.where(
+        values - sorted_values[left_ind] <= sorted_values[right_ind] - values,
+        left_ind, right_ind)
+
+
 def _setup_distance(linear_position, nodes_df):
     linear_position = linear_position.squeeze()
-    bin_ind = np.searchsorted(nodes_df.linear_position.values, linear_position)
-    is_same_edge = (nodes_df.iloc[bin_ind - 1].edge_id.values ==
-                    nodes_df.iloc[bin_ind].edge_id.values)
+    node_linear_position = nodes_df.linear_position.to_numpy()
+    node_edge_id = nodes_df.edge_id.to_numpy()
+    node_ids = nodes_df.node_ids.to_numpy()
+
+    bin_ind = np.searchsorted(node_linear_position, linear_position)
+    is_same_edge = node_edge_id[bin_ind - 1] == node_edge_id[bin_ind]
 
     left_node_ind = bin_ind - 1
     right_node_ind = bin_ind
 
-    right_node_ind[~is_same_edge] = left_node_ind[~is_same_edge] = np.argmin(
-        np.abs(linear_position[~is_same_edge, np.newaxis] -
-               nodes_df.linear_position.values), axis=1)
+    right_node_ind[~is_same_edge] = left_node_ind[~is_same_edge] = (
+        _find_closest_ind(node_linear_position,
+                          linear_position[~is_same_edge]))
 
-    left_node_id = nodes_df.node_ids.values[left_node_ind]
-    right_node_id = nodes_df.node_ids.values[right_node_ind]
-    left_dist = np.abs(
-        nodes_df.linear_position.values[left_node_ind] - linear_position)
-    right_dist = np.abs(
-        nodes_df.linear_position.values[left_node_ind] - linear_position)
+    left_node_id = node_ids[left_node_ind]
+    right_node_id = node_ids[right_node_ind]
+    left_dist = np.abs(node_linear_position[left_node_ind] - linear_position)
+    right_dist = np.abs(node_linear_position[right_node_ind] - linear_position)
 
     return left_node_id, right_node_id, left_dist, right_dist
 
 
-def get_distance2(track_graph, left_node_id, right_node_id, left_dist,
-                  right_dist, place_bin_center_to_node_id):
-    nx.add_path(track_graph, [left_node_id, 'a'], distance=left_dist)
-    nx.add_path(track_graph, ['a', right_node_id], distance=right_dist)
-    dist = nx.single_source_dijkstra_path_length(
-        track_graph, source='a', weight="distance")
-    track_graph.remove_node('a')
-    r = np.array([dist[id] for id in place_bin_center_to_node_id])
-
-    return r
+def get_node_distances(track_graph, node_ids, indices=None):
+    '''Shortest path distance along the track between nodes.
 
+    Parameters
+    ----------
+    track_graph : networkx.Graph
+    node_ids : np.ndarray, shape (n_nodes,)
+    indices : None or np.ndarray, shape (n_indices,), optional
+        Index into `node_ids` of the source nodes. If None, all nodes are
+        used as sources.
 
-@dask.delayed
-def batch_distance(track_graph, left_node_id, right_node_id,
-                   left_dist, right_dist, place_bin_center_to_node_id):
-    copy_graph = track_graph.copy()
+    Returns
+    -------
+    node_distances : np.ndarray, shape (n_indices, n_nodes)
 
-    return np.stack(
-        [get_distance2(copy_graph, l_id, r_id, l_d, r_d,
-                       place_bin_center_to_node_id)
-         for l_id, r_id, l_d, r_d in zip(left_node_id, right_node_id,
-                                         left_dist, right_dist)], axis=0)
+    '''
+    adjacency = nx.to_scipy_sparse_array(
+        track_graph, nodelist=node_ids, weight='distance', format='csr')
+    # `dijkstra` only accepts 32-bit index arrays
+    adjacency.indices = adjacency.indices.astype(np.int32)
+    adjacency.indptr = adjacency.indptr.astype(np.int32)
+    return dijkstra(adjacency, directed=False, indices=indices)
 
 
-def batch(n_samples, batch_size=1):
-    for ind in range(0, n_samples, batch_size):
-        yield range(ind, min(ind + batch_size, n_samples))
+def _get_node_ind(node_ids, query_node_ids):
+    sort_ind = np.argsort(node_ids)
+    return sort_ind[np.searchsorted(node_ids, query_node_ids, sorter=sort_ind)]
 
 
 def convert_linear_position_to_track_distances(
         linear_position, track_graph, nodes_df, place_bin_center_to_node_id):
-    '''
+    '''Distance along the track from each position to each place bin
+    center.
+
+    The position is treated as a virtual node between its neighboring
+    left and right nodes, so its distance to a place bin center is the
+    shorter of the two paths through those neighbors.
 
     Parameters
     ----------
+    linear_position : np.ndarray, shape (n_time,)
+    track_graph : networkx.Graph
+    nodes_df : pandas.DataFrame
+    place_bin_center_to_node_id : np.ndarray, shape (n_place_bins,)
 
     Returns
     -------
@@ -76,25 +107,69 @@ def convert_linear_position_to_track_distances(
      left_dist,
      right_dist) = _setup_distance(linear_position, nodes_df)
 
-    n_time = linear_position.shape[0]
-    track_distances = []
-    for time_ind in batch(n_time, batch_size=10_000):
-        track_distances.append(
-            batch_distance(
-                track_graph, left_node_id[time_ind], right_node_id[time_ind],
-                left_dist[time_ind], right_dist[time_ind],
-                place_bin_center_to_node_id))
+    node_ids = np.asarray(track_graph.nodes)
+    node_to_bin_distances = get_node_distances(
+        track_graph, node_ids,
+        indices=_get_node_ind(node_ids, place_bin_center_to_node_id)).T
 
-    return np.concatenate(
-        dask.compute(*track_distances, scheduler='processes'), axis=0)
+    return np.minimum(
+        left_dist[:, np.newaxis] +
+        node_to_bin_distances[_get_node_ind(node_ids, left_node_id)],
+        right_dist[:, np.newaxis] +
+        node_to_bin_distances[_get_node_ind(node_ids, right_node_id)])
 
 
 def get_gaussian_track_distances(track_distances, variance=8):
-    return multivariate_normal(mean=0, cov=variance).pdf(
-        track_distances.ravel()).reshape(track_distances.shape)
+    '''Evaluates a zero-mean univariate Gaussian at each track distance.
+
+    Parameters
+    ----------
+    track_distances : np.ndarray, shape (n_time, n_place_bins)
+    variance : float, optional
+
+    Returns
+    -------
+    gaussian_track_distances : np.ndarray, shape (n_time, n_place_bins)
+
+    '''
+    gaussian_track_distances = np.empty_like(track_distances, dtype=float)
+    np.multiply(track_distances, track_distances,
+                out=gaussian_track_distances)
+    gaussian_track_distances *= -0.5 / variance
+    np.exp(gaussian_track_distances, out=gaussian_track_distances)
+    gaussian_track_distances /= np.sqrt(2.0 * np.pi * variance)
+
+    return gaussian_track_distances
+
+
+@numba.njit(nogil=True, cache=False, error_model='numpy')
+def _get_kernel_constants(bandwidths):
+    '''Per-mark inverse bandwidths and the log of the normalization shared
+    by every evaluation of the product kernel.
+
+    Parameters
+    ----------
+    bandwidths : np.ndarray, shape (n_marks,)
+
+    Returns
+    -------
+    inverse_bandwidths : np.ndarray, shape (n_marks,)
+    log_normalization : float
+
+    '''
+    n_bandwidths = bandwidths.shape[0]
+    inverse_bandwidths = np.empty((n_bandwidths,))
+    log_normalization = 0.0
+    for k in range(n_bandwidths):
+        inverse_bandwidths[k] = 1.0 / bandwidths[k]
+        log_normalization += np.log(
+            inverse_bandwidths[k] * inverse_bandwidths[k] / SQRT_2PI)
+
+    return inverse_bandwidths, log_normalization
 
 
-@numba.njit(nogil=True, cache=False, parallel=True, error_model='numpy')
+@numba.njit(nogil=True, cache=False, parallel=True, error_model='numpy',
+            fastmath=True)
 def numba_product(eval_point, samples, bandwidths):
     '''
     Parameters
@@ -108,19 +183,99 @@ def numba_product(eval_point, samples, bandwidths):
 
     '''
     n_samples, n_bandwidths = samples.shape
-    product_kernel = np.ones((n_samples,))
+    product_kernel = np.empty((n_samples,))
+
+    inverse_bandwidths, log_normalization = _get_kernel_constants(bandwidths)
 
     for j in numba.prange(n_samples):
+        squared_distance = 0.0
         for k in range(n_bandwidths):
-            bandwidth = bandwidths[k]
-            sample = samples[j, k]
-            product_kernel[j] *= (np.exp(
-                -0.5 * ((eval_point[k] - sample) / bandwidth)**2) /
-                (bandwidth * SQRT_2PI)) / bandwidth
+            distance = (eval_point[k] - samples[j, k]) * inverse_bandwidths[k]
+            squared_distance += distance * distance
+        product_kernel[j] = np.exp(-0.5 * squared_distance + log_normalization)
 
     return product_kernel
 
 
+def _make_kde_fused_kernel(n_marks):
+    '''Compiles the fused KDE kernel for a fixed number of marks so that
+    LLVM can fully unroll the loop over marks.'''
+    @numba.njit(nogil=True, cache=False, parallel=True, error_model='numpy',
+                fastmath=True)
+    def kde_fused_kernel(eval_points, samples, bandwidths,
+                         gaussian_track_distances, eval_block_size,
+                         sample_block_size):
+        n_eval_points = eval_points.shape[0]
+        n_samples = samples.shape[0]
+        n_bins = gaussian_track_distances.shape[1]
+        kde = np.zeros((n_eval_points, n_bins))
+
+        inverse_bandwidths, log_normalization = _get_kernel_constants(
+            bandwidths)
+
+        n_eval_blocks = (
+            (n_eval_points + eval_block_size - 1) // eval_block_size)
+        for block_ind in numba.prange(n_eval_blocks):
+            eval_start = block_ind * eval_block_size
+            eval_stop = min(eval_start + eval_block_size, n_eval_points)
+            for sample_start in range(0, n_samples, sample_block_size):
+                sample_stop = min(sample_start + sample_block_size, n_samples)
+                product_kernel = np.empty(
+                    (eval_stop - eval_start, sample_stop - sample_start))
+                for i in range(eval_start, eval_stop):
+                    for j in range(sample_start, sample_stop):
+                        squared_distance = 0.0
+                        for k in range(n_marks):
+                            distance = (
+                                (eval_points[i, k] - samples[j, k]) *
+                                inverse_bandwidths[k])
+                            squared_distance += distance * distance
+                        product_kernel[i - eval_start, j - sample_start] = (
+                            np.exp(-0.5 * squared_distance +
+                                   log_normalization))
+                kde[eval_start:eval_stop] += (
+                    product_kernel @
+                    gaussian_track_distances[sample_start:sample_stop])
+
+        return kde
+
+    return kde_fused_kernel
+
+
+_KDE_FUSED_KERNELS = {}
+
+
+def numba_kde_fused(eval_points, samples, bandwidths,
+                    gaussian_track_distances, eval_block_size=64,
+                    sample_block_size=256):
+    '''Product kernel over marks times the gaussian track distances,
+    evaluated in blocks of test and train spikes so that the full
+    (n_test, n_train) kernel matrix is never stored.
+
+    Parameters
+    ----------
+    eval_points : np.ndarray, shape (n_test, n_marks)
+    samples : np.ndarray, shape (n_train, n_marks)
+    bandwidths : np.ndarray, shape (n_marks,)
+    gaussian_track_distances : np.ndarray, shape (n_train, n_bins)
+    eval_block_size : int, optional
+    sample_block_size : int, optional
+
+    Returns
+    -------
+    kde : np.ndarray, shape (n_test, n_bins)
+
+    '''
+    n_marks = eval_points.shape[1]
+    try:
+        kernel = _KDE_FUSED_KERNELS[n_marks]
+    except KeyError:
+        kernel = _KDE_FUSED_KERNELS[n_marks] = _make_kde_fused_kernel(n_marks)
+
+    return kernel(eval_points, samples, bandwidths, gaussian_track_distances,
+                  eval_block_size, sample_block_size)
+
+
 def get_kde(test_multiunit, train_multiunit, is_track_interior, bandwidths,
             gaussian_track_distances):
     '''
@@ -138,47 +293,107 @@ def get_kde(test_multiunit, train_multiunit, is_track_interior, bandwidths,
     kde : np.ndarray, shape (n_test, n_bins)
 
     '''
-    n_test, n_bins = test_multiunit.shape[0], gaussian_track_distances.shape[1]
+    is_track_interior = np.asarray(is_track_interior, dtype=bool).ravel()
+    test_multiunit = np.ascontiguousarray(test_multiunit)
+    train_multiunit = np.ascontiguousarray(train_multiunit)
+    bandwidths = np.ascontiguousarray(bandwidths)
+    # Only evaluate the interior bins, in the fused kernel's float64
+    gaussian_track_distances = np.ascontiguousarray(
+        gaussian_track_distances[:, is_track_interior], dtype=np.float64)
+
+    n_test, n_bins = test_multiunit.shape[0], is_track_interior.size
     kde = np.zeros((n_test, n_bins))
-    for ind in range(n_test):
-        kde[ind, is_track_interior] = (
-            numba_product(test_multiunit[ind], train_multiunit, bandwidths) @
-            gaussian_track_distances)
+    kde[:, is_track_interior] = numba_kde_fused(
+        test_multiunit, train_multiunit, bandwidths, gaussian_track_distances)
 
     return kde
 
 
-@numba.njit(nogil=True, cache=False, parallel=True)
-def numba_kde(eval_points, samples, bandwidths, precalculated_kernel):
+def numba_kde(eval_points, samples, bandwidths, precalculated_kernel=None):
+    '''
+    Parameters
+    ----------
+    eval_points : np.ndarray, shape (n_test, n_marks)
+    samples : np.ndarray, shape (n_train, n_marks)
+    bandwidths : np.ndarray, shape (n_marks,)
+    precalculated_kernel : None or np.ndarray, shape (n_train, n_grid)
+
+    Returns
+    -------
+    kde : np.ndarray, shape (n_test, n_grid) or (n_test, 1) if None
+
+    '''
+    eval_points = np.ascontiguousarray(eval_points)
+    samples = np.ascontiguousarray(samples)
+    bandwidths = np.ascontiguousarray(bandwidths)
+    if precalculated_kernel is None:
+        return _numba_kde_no_precalculated(eval_points, samples, bandwidths)
+    return _numba_kde_precalculated(
+        eval_points, samples, bandwidths,
+        np.ascontiguousarray(precalculated_kernel))
+
+
+@numba.njit(nogil=True, cache=False, parallel=True, fastmath=True)
+def _numba_kde_no_precalculated(eval_points, samples, bandwidths):
+    n_eval_points, n_bandwidths = eval_points.shape
+    result = np.zeros((n_eval_points, 1))
+    n_samples = len(samples)
+
+    inverse_bandwidths, log_normalization = _get_kernel_constants(bandwidths)
+    log_normalization -= np.log(n_samples)
+
+    for eval_ind in numba.prange(n_eval_points):
+        for sample_ind in range(n_samples):
+            squared_distance = 0.0
+            for bandwidth_ind in range(n_bandwidths):
+                distance = (
+                    (eval_points[eval_ind, bandwidth_ind] -
+                     samples[sample_ind, bandwidth_ind]) *
+                    inverse_bandwidths[bandwidth_ind])
+                squared_distance += distance * distance
+            result[eval_ind, 0] += np.exp(
+                -0.5 * squared_distance + log_normalization)
+
+    return result
+
+
+@numba.njit(nogil=True, cache=False, parallel=True, fastmath=True)
+def _numba_kde_precalculated(eval_points, samples, bandwidths,
+                             precalculated_kernel):
     n_eval_points, n_bandwidths = eval_points.shape
     n_grid = precalculated_kernel.shape[1]
     result = np.zeros((n_eval_points, n_grid))
     n_samples = len(samples)
 
-    for eval_ind in range(n_eval_points):
+    inverse_bandwidths, log_normalization = _get_kernel_constants(bandwidths)
+    log_normalization -= np.log(n_samples)
+
+    for eval_ind in numba.prange(n_eval_points):
         for sample_ind in range(n_samples):
-            product_kernel = 1.0
+            squared_distance = 0.0
             for bandwidth_ind in range(n_bandwidths):
-                bandwidth = bandwidths[bandwidth_ind]
-                eval_point = eval_points[eval_ind, bandwidth_ind]
-                sample = samples[sample_ind, bandwidth_ind]
-                product_kernel *= (np.exp(
-                    -0.5 * ((eval_point - sample) / bandwidth)**2) /
-                    (bandwidth * SQRT_2PI)) / bandwidth
+                distance = (
+                    (eval_points[eval_ind, bandwidth_ind] -
+                     samples[sample_ind, bandwidth_ind]) *
+                    inverse_bandwidths[bandwidth_ind])
+                squared_distance += distance * distance
+            product_kernel = np.exp(
+                -0.5 * squared_distance + log_normalization)
             for grid_ind in range(n_grid):
                 result[eval_ind, grid_ind] += (
-                    product_kernel * precalculated_kernel[sample_ind, grid_ind]
-                    / n_samples)
+                    product_kernel *
+                    precalculated_kernel[sample_ind, grid_ind])
 
     return result
 
 
 @numba.njit(nogil=True, cache=False, parallel=True, fastmath=True)
 def gaussian_kernel(eval_point, bandwidths, sample, n_bandwidths):
-    product_kernel = 1.0
+    squared_distance = 0.0
+    normalization = 1.0
     for k in range(n_bandwidths):
         bandwidth = bandwidths[k]
-        product_kernel *= (np.exp(
-            -0.5 * ((eval_point[k] - sample[k]) / bandwidth)**2) /
-            (bandwidth * SQRT_2PI)) / bandwidth
-    return product_kernel
+        distance = (eval_point[k] - sample[k]) / bandwidth
+        squared_distance += distance * distance
+        normalization *= bandwidth * SQRT_2PI * bandwidth
+    return np.exp(-0.5 * squared_distance) / normalization
@@ -34,14 +34,18 @@ def speed_likelihood(speed, lagged_speed, replay_coefficients,
     speed_likelihood : ndarray, shape (n_time, 2, 1)
 
     """
-    no_replay_prediction = _predict(no_replay_coefficients, lagged_speed)
-    replay_prediction = _predict(replay_coefficients, lagged_speed)
     n_time = speed.shape[0]
-    speed_likelihood = np.zeros((n_time, 2, 1))
-    speed_likelihood[:, 0, :] = (FAMILY.loglike_obs(
-        speed, no_replay_prediction, scale=no_replay_scale))[:, np.newaxis]
-    speed_likelihood[:, 1, :] = (FAMILY.loglike_obs(
-        speed, replay_prediction, scale=replay_scale))[:, np.newaxis]
+    speed_likelihood = np.empty((n_time, 2, 1))
+    no_replay_log_likelihood = speed_likelihood[:, 0, 0]
+    replay_log_likelihood = speed_likelihood[:, 1, 0]
+
+    _predict(no_replay_coefficients, lagged_speed,
+             out=no_replay_log_likelihood)
+    _gaussian_log_likelihood(speed, no_replay_log_likelihood,
+                             no_replay_scale, out=no_replay_log_likelihood)
+    _predict(replay_coefficients, lagged_speed, out=replay_log_likelihood)
+    _gaussian_log_likelihood(speed, replay_log_likelihood, replay_scale,
+                             out=replay_log_likelihood)
 
     return scale_likelihood(speed_likelihood)
 
@@ -82,5 +86,33 @@ def fit_speed_model(speed, lagged_speed):
     return results.params, results.scale
 
 
-def _predict(coefficients, lagged_speed):
-    return FAMILY.link.inverse(lagged_speed * coefficients)
+def _predict(coefficients, lagged_speed, out=None):
+    """Inverse of the log link, exp(lagged_speed * coefficients)."""
+    prediction = np.multiply(lagged_speed, coefficients, out=out)
+    return np.exp(prediction, out=prediction)
+
+
+def _gaussian_log_likelihood(speed, prediction, scale, out=None):
+    """Gaussian log likelihood of the speed given the predicted speed.
+
+    The log(2 * pi) / 2 term is dropped because it is the same for both
+    states and is removed by `scale_likelihood`.
+
+    Parameters
+    ----------
+    speed : ndarray, shape (n_time,)
+    prediction : ndarray, shape (n_time,)
+    scale : float
+    out : None or ndarray, shape (n_time,), optional
+        Array to store the result in. Can be `prediction`.
+
+    Returns
+    -------
+    log_likelihood : ndarray, shape (n_time,)
+
+    """
+    squared_residual = np.subtract(speed, prediction, out=out)
+    np.square(squared_residual, out=squared_residual)
+    squared_residual *= -0.5 / scale
+    squared_residual -= 0.5 * np.log(scale)
+    return squared_residual
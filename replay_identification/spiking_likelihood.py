@@ -138,17 +138,37 @@ def spiking_likelihood(
 
 
 def combined_likelihood(spikes, conditional_intensity, time_bin_size=1):
-    n_time = spikes.shape[1]
-    n_bins = (conditional_intensity.shape[-1]
-              if conditional_intensity.ndim > 2 else 1)
-    log_likelihood = np.zeros((n_time, n_bins))
+    """Poisson log likelihood summed over neurons.
 
-    for is_spike, ci in zip(tqdm(spikes, desc='neurons'),
-                            conditional_intensity):
-        log_likelihood += atleast_2d(
-            poisson_log_likelihood(is_spike, ci, time_bin_size))
+    Parameters
+    ----------
+    spikes : ndarray, shape (n_neurons, n_time) or (n_neurons, n_time, 1)
+    conditional_intensity : ndarray, shape (n_neurons, n_time) or
+                            (n_neurons, 1, n_place_bins)
+    time_bin_size : float, optional
 
-    return log_likelihood
+    Returns
+    -------
+    log_likelihood : ndarray, shape (n_time, n_place_bins) or (n_time, 1)
+
+    """
+    if conditional_intensity.ndim > 2:
+        # The intensity only depends on place, so the sum over neurons of
+        # is_spike * log(intensity) is a matrix product.
+        if conditional_intensity.shape[1] != 1:
+            raise ValueError(
+                'conditional_intensity must have shape '
+                '(n_neurons, 1, n_place_bins), got '
+                f'{conditional_intensity.shape}')
+        n_neurons, n_time = spikes.shape[:2]
+        conditional_intensity = conditional_intensity.reshape((n_neurons, -1))
+        return (spikes.reshape((n_neurons, n_time)).T @
+                np.log(conditional_intensity + np.spacing(1)) -
+                time_bin_size * conditional_intensity.sum(axis=0))
+
+    return atleast_2d(np.sum(
+        poisson_log_likelihood(spikes, conditional_intensity, time_bin_size),
+        axis=0))
 
 
 def fit_spiking_likelihood(position, spikes, is_training,
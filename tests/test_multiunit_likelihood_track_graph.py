@@ -0,0 +1,187 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from pytest import mark
+from replay_identification.core import get_track_grid
+from replay_identification.multiunit_likelihood_track_graph import (
+    _find_closest_ind, _setup_distance,
+    convert_linear_position_to_track_distances, get_gaussian_track_distances,
+    get_kde, numba_kde)
+
+SQRT_2PI = np.sqrt(2.0 * np.pi)
+
+
+def _dense_product_kernel(eval_points, samples, bandwidths):
+    '''Product over marks of gaussian kernels, shape (n_test, n_train).'''
+    distance = ((eval_points[:, np.newaxis, :] - samples[np.newaxis]) /
+                bandwidths)
+    return np.prod(np.exp(-0.5 * distance ** 2) /
+                   (bandwidths * SQRT_2PI) / bandwidths, axis=-1)
+
+
+@mark.parametrize('n_test, n_train, n_marks', [
+    (1, 1, 4),
+    (130, 700, 4),
+    (65, 257, 5),
+])
+def test_get_kde(n_test, n_train, n_marks):
+    rng = np.random.default_rng(0)
+    test_multiunit = rng.normal(scale=20.0, size=(n_test, n_marks))
+    train_multiunit = rng.normal(scale=20.0, size=(n_train, n_marks))
+    bandwidths = np.full((n_marks,), 20.0)
+    n_bins = 33
+    gaussian_track_distances = rng.random((n_train, n_bins))
+    is_track_interior = np.ones((n_bins, 1), dtype=bool)
+    is_track_interior[[0, 10, 11]] = False
+
+    kde = get_kde(test_multiunit, train_multiunit, is_track_interior,
+                  bandwidths, gaussian_track_distances)
+    expected_kde = _dense_product_kernel(
+        test_multiunit, train_multiunit, bandwidths
+    ) @ gaussian_track_distances
+
+    is_track_interior = is_track_interior.squeeze()
+    assert kde.shape == (n_test, n_bins)
+    assert np.allclose(kde[:, is_track_interior],
+                       expected_kde[:, is_track_interior], rtol=1e-8, atol=0)
+    assert np.all(kde[:, ~is_track_interior] == 0.0)
+
+
+@mark.parametrize('n_marks, spread', [
+    (4, 150.0),
+    (8, 80.0),
+    (8, 120.0),
+])
+def test_get_kde_outlying_marks(n_marks, spread):
+    rng = np.random.default_rng(3)
+    test_multiunit = rng.normal(scale=spread, size=(130, n_marks))
+    train_multiunit = rng.normal(scale=20.0, size=(700, n_marks))
+    bandwidths = np.full((n_marks,), 20.0)
+    gaussian_track_distances = get_gaussian_track_distances(
+        rng.uniform(0.0, 20.0, size=(700, 25)))
+    is_track_interior = np.ones((25, 1), dtype=bool)
+
+    kde = get_kde(test_multiunit, train_multiunit, is_track_interior,
+                  bandwidths, gaussian_track_distances)
+    kde_float32 = get_kde(
+        test_multiunit, train_multiunit, is_track_interior, bandwidths,
+        gaussian_track_distances.astype(np.float32))
+
+    assert np.all(kde > 0.0)
+    assert np.all(kde_float32 > 0.0)
+    assert np.allclose(kde_float32, kde, rtol=1e-5, atol=0)
+
+
+def test_get_gaussian_track_distances():
+    track_distances = np.array([[0.0, 10.0], [40.0, 100.0]])
+    gaussian_track_distances = get_gaussian_track_distances(
+        track_distances, variance=8)
+
+    expected = (np.exp(-0.5 * track_distances ** 2 / 8) /
+                np.sqrt(2.0 * np.pi * 8))
+    assert np.allclose(gaussian_track_distances, expected, rtol=1e-12,
+                       atol=0)
+    assert np.all(gaussian_track_distances > 0.0)
+
+
+def test_numba_kde():
+    rng = np.random.default_rng(2)
+    eval_points = rng.normal(scale=20.0, size=(40, 4))
+    samples = rng.normal(scale=20.0, size=(300, 4))
+    bandwidths = np.full((4,), 20.0)
+    precalculated_kernel = rng.random((300, 17))
+    product_kernel = _dense_product_kernel(eval_points, samples, bandwidths)
+
+    assert np.allclose(
+        numba_kde(eval_points, samples, bandwidths, precalculated_kernel),
+        product_kernel @ precalculated_kernel / samples.shape[0],
+        rtol=1e-8, atol=0)
+    assert np.allclose(
+        numba_kde(eval_points, samples, bandwidths),
+        product_kernel.mean(axis=1, keepdims=True), rtol=1e-8, atol=0)
+
+
+def _make_track_grid():
+    '''Y-shaped track with a stem and two arms.'''
+    node_positions = [(0.0, 0.0), (0.0, 30.0), (-20.0, 50.0), (20.0, 50.0)]
+    track_graph = nx.Graph()
+    for node_id, node_position in enumerate(node_positions):
+        track_graph.add_node(node_id, pos=node_position)
+    for node1, node2 in [(0, 1), (1, 2), (1, 3)]:
+        track_graph.add_edge(node1, node2, distance=np.linalg.norm(
+            np.subtract(node_positions[node1], node_positions[node2])))
+    track_grid = get_track_grid(
+        track_graph, center_well_id=0, edge_order=[0, 1, 2],
+        edge_spacing=[0.0, 0.0], place_bin_size=2.0)
+    place_bin_center_to_node_id, track_graph_with_bins, nodes_df = (
+        track_grid[4], track_grid[9], track_grid[11])
+    return track_graph_with_bins, nodes_df, place_bin_center_to_node_id
+
+
+def test_convert_linear_position_to_track_distances():
+    track_graph, nodes_df, place_bin_center_to_node_id = _make_track_grid()
+    node_linear_position = nodes_df.linear_position.values
+    rng = np.random.default_rng(1)
+    linear_position = np.concatenate((
+        rng.uniform(node_linear_position.min() + 0.01,
+                    node_linear_position.max() - 0.01, size=200),
+        node_linear_position[1:-1:5]))
+
+    track_distances = convert_linear_position_to_track_distances(
+        linear_position[:, np.newaxis], track_graph, nodes_df,
+        place_bin_center_to_node_id)
+
+    # Insert each position as a node and run Dijkstra from it
+    expected_track_distances = []
+    for left_node_id, right_node_id, left_dist, right_dist in zip(
+            *_setup_distance(linear_position[:, np.newaxis], nodes_df)):
+        graph = track_graph.copy()
+        graph.add_edge(left_node_id, 'position', distance=left_dist)
+        if right_node_id != left_node_id:
+            graph.add_edge('position', right_node_id, distance=right_dist)
+        distance = nx.single_source_dijkstra_path_length(
+            graph, source='position', weight='distance')
+        expected_track_distances.append(
+            [distance[node_id] for node_id in place_bin_center_to_node_id])
+
+    assert track_distances.shape == (
+        linear_position.size, len(place_bin_center_to_node_id))
+    assert np.allclose(track_distances, expected_track_distances)
+
+
+@mark.parametrize('sorted_values', [
+    np.array([0.0, 1.0, 2.0, 5.0, 9.0]),
+    np.array([0.0, 0.0, 3.0, 3.0, 3.0, 7.0, 10.0, 10.0]),
+])
+def test_find_closest_ind(sorted_values):
+    values = np.concatenate((
+        np.linspace(-5.0, 15.0, 81),
+        sorted_values,
+        (sorted_values[:-1] + sorted_values[1:]) / 2))
+    expected_ind = np.argmin(
+        np.abs(values[:, np.newaxis] - sorted_values), axis=1)
+
+    assert np.array_equal(_find_closest_ind(sorted_values, values),
+                          expected_ind)
+
+
+def test_setup_distance():
+    nodes_df = pd.DataFrame(dict(
+        node_ids=[10, 11, 12, 13, 14],
+        edge_id=[0, 0, 0, 1, 1],
+        linear_position=[0.0, 4.0, 10.0, 20.0, 30.0]))
+    linear_position = np.array([1.0, 7.0, 26.0, 14.0])
+
+    (left_node_id, right_node_id,
+     left_dist, right_dist) = _setup_distance(linear_position, nodes_df)
+
+    # Positions between nodes on the same edge
+    assert np.array_equal(left_node_id[:3], [10, 11, 13])
+    assert np.array_equal(right_node_id[:3], [11, 12, 14])
+    assert np.allclose(left_dist[:3], [1.0, 3.0, 6.0])
+    assert np.allclose(right_dist[:3], [3.0, 3.0, 4.0])
+
+    # Position between edges uses the closest node on both sides
+    assert left_node_id[3] == right_node_id[3] == 12
+    assert np.allclose([left_dist[3], right_dist[3]], 4.0)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from replay_identification.spiking_likelihood import (combined_likelihood,
+                                                      poisson_log_likelihood)
+
+TIME_BIN_SIZE = 0.002
+
+
+def _make_spikes(n_time=500, n_neurons=12):
+    rng = np.random.default_rng(0)
+    return (rng.random((n_time, n_neurons)) < 0.1).astype(float)
+
+
+def test_combined_likelihood_place():
+    is_spike = _make_spikes()
+    rng = np.random.default_rng(1)
+    place_conditional_intensity = rng.uniform(0.0, 3.0, size=(40, 12))
+
+    log_likelihood = combined_likelihood(
+        is_spike.T[..., np.newaxis],
+        place_conditional_intensity.T[:, np.newaxis, :], TIME_BIN_SIZE)
+
+    expected = np.zeros((500, 40))
+    for is_neuron_spike, intensity in zip(
+            is_spike.T, place_conditional_intensity.T):
+        expected += poisson_log_likelihood(
+            is_neuron_spike[:, np.newaxis], intensity[np.newaxis],
+            TIME_BIN_SIZE)
+
+    assert log_likelihood.shape == (500, 40)
+    assert np.allclose(log_likelihood, expected, rtol=1e-10, atol=0)
+
+
+def test_combined_likelihood_local():
+    is_spike = _make_spikes()
+    rng = np.random.default_rng(2)
+    local_conditional_intensity = rng.uniform(0.0, 3.0, size=(500, 12))
+
+    log_likelihood = combined_likelihood(
+        is_spike.T, local_conditional_intensity.T, TIME_BIN_SIZE)
+
+    expected = np.zeros((500,))
+    for is_neuron_spike, intensity in zip(
+            is_spike.T, local_conditional_intensity.T):
+        expected += poisson_log_likelihood(
+            is_neuron_spike, intensity, TIME_BIN_SIZE)
+
+    assert log_likelihood.shape == (500, 1)
+    assert np.allclose(log_likelihood[:, 0], expected, rtol=1e-10, atol=0)
+
+
+def test_combined_likelihood_rejects_time_varying_place_intensity():
+    is_spike = _make_spikes()
+    conditional_intensity = np.ones((12, 500, 40))
+
+    with pytest.raises(ValueError):
+        combined_likelihood(is_spike.T[..., np.newaxis],
+                            conditional_intensity, TIME_BIN_SIZE)